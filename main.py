@@ -8,6 +8,7 @@ from PIL import Image, ImageDraw, ImageFont
 import json
 import csv
 import os
+import time
 from datetime import datetime
 
 # Создаем экземпляр FastAPI приложения
@@ -42,11 +43,29 @@ ANNOTATION_CONFIG = {
     'brightness_threshold': 128,        # Если яркость > 128 - черный текст, иначе белый
 }
 
+# КОНФИГУРАЦИЯ КЭША СЕССИЙ - ПРОПУСК ПОЧТИ ОДИНАКОВЫХ КАДРОВ
+SESSION_CACHE_CONFIG = {
+    # Размер перцептивного хэша (difference hash): hash_size x hash_size бит
+    # Внимание: при хэше 8x8 (64 бита) и пороге 4 небольшой новый объект
+    # (например, 100x60 px на кадре 640x480 меняет всего ~2 бита) может быть пропущен.
+    # Поэтому используем более подробный хэш 16x16 и низкий порог
+    'hash_size': 16,                    # 16 -> 256-битный хэш
+    
+    # Порог схожести кадров
+    'max_hash_distance': 2,             # Максимальное расстояние Хэмминга между хэшами (из 256 бит)
+    
+    # Время жизни и размер кэша
+    'max_cache_age_seconds': 10,        # Максимальный возраст детекций: после этого кадр обязательно проходит инференс
+    'session_ttl_seconds': 60,          # Сессия удаляется, если к ней не обращались дольше этого времени
+    'max_sessions': 1000,               # Максимальное количество одновременно хранимых сессий
+}
+
 # Глобальные переменные
 current_model = None # Модель
 translation_dict = {} # Словарь переводов
 model_config = {} # Конфигурация
 current_font = None # Шрифт
+session_cache = {} # Кэш сессий: session_id -> последний кадр и его детекции
 
 def load_model_config():
     """
@@ -357,6 +376,7 @@ def calculate_line_thickness(image_height):
 def create_custom_annotated_image(image, results, detections, language):
     """
     Создание аннотированного изображения с переведенными метками
+    Если results равен None, боксы берутся из списка detections
     """
     # Получаем конфигурационные параметры
     config = ANNOTATION_CONFIG
@@ -392,14 +412,23 @@ def create_custom_annotated_image(image, results, detections, language):
         font = ImageFont.load_default()
     
     # ШАГ 3: ОБРАБОТКА КАЖДОГО BOUNDING BOX
-    boxes = results[0].boxes
+    # Если results нет (ответ из кэша сессии) - рисуем боксы по сохраненным детекциям
+    if results is not None:
+        boxes = results[0].boxes
+    else:
+        boxes = detections
     
     if boxes is not None:
         for i, box in enumerate(boxes):
-            # Координаты bounding box (приводим к int)
-            x1, y1, x2, y2 = box.xyxy[0].cpu().numpy().astype(int)
-            confidence = float(box.conf) # Уверенность
-            class_id = int(box.cls) # ID класса
+            if results is not None:
+                # Координаты bounding box (приводим к int)
+                x1, y1, x2, y2 = box.xyxy[0].cpu().numpy().astype(int)
+                confidence = float(box.conf) # Уверенность
+                class_id = int(box.cls) # ID класса
+            else:
+                x1, y1, x2, y2 = [int(v) for v in box['bbox']]
+                confidence = box['confidence']
+                class_id = box['class_id']
             
             # Получаем переведенную метку из наших детекций
             if i < len(detections):
@@ -467,6 +496,114 @@ def create_custom_annotated_image(image, results, detections, language):
     
     return np.array(pil_image)
 
+def compute_frame_hash(image_array):
+    """
+    Вычисляет перцептивный хэш кадра (difference hash)
+    
+    Кадр переводится в оттенки серого, уменьшается до (hash_size + 1) x hash_size,
+    и для каждого пикселя сравнивается яркость с соседом справа.
+    Небольшие изменения (шум камеры, сжатие JPEG) почти не меняют хэш.
+    
+    Args:
+        image_array (np.ndarray): Изображение в формате RGB
+    
+    Returns:
+        np.ndarray: Массив бит хэша (bool)
+    """
+    hash_size = SESSION_CACHE_CONFIG['hash_size']
+    
+    if image_array.ndim == 3:
+        gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+    else:
+        gray = image_array
+    
+    resized = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return (resized[:, 1:] > resized[:, :-1]).flatten()
+
+def cleanup_expired_sessions():
+    """Удаляет из кэша сессии, к которым не обращались дольше TTL"""
+    ttl = SESSION_CACHE_CONFIG['session_ttl_seconds']
+    now = time.monotonic()
+    
+    expired = [sid for sid, entry in session_cache.items() if now - entry['last_access'] > ttl]
+    for sid in expired:
+        del session_cache[sid]
+    
+    if expired:
+        print(f"🧹 Удалено устаревших сессий: {len(expired)}")
+
+def get_cached_detections(session_id, frame_hash, image_shape, confidence, language):
+    """
+    Поиск детекций для почти одинакового кадра в кэше сессии
+    
+    Args:
+        session_id (str): Идентификатор сессии клиента
+        frame_hash (np.ndarray): Перцептивный хэш нового кадра
+        image_shape (tuple): Размер нового кадра
+        confidence (float): Порог уверенности текущего запроса
+        language (str): Язык для перевода меток ('en' или 'ru')
+    
+    Returns:
+        list | None: Детекции с переведенными метками или None, если нужен новый инференс
+    """
+    entry = session_cache.get(session_id)
+    if entry is None:
+        return None
+    
+    # Детекции слишком старые - выполняем новый инференс, даже если клиент опрашивает часто
+    now = time.monotonic()
+    if now - entry['inferred_at'] > SESSION_CACHE_CONFIG['max_cache_age_seconds']:
+        return None
+    
+    # Кадр другого размера или порог ниже кэшированного - в кэше может не хватать детекций
+    if entry['image_shape'] != image_shape or confidence < entry['confidence']:
+        return None
+    
+    distance = int(np.count_nonzero(entry['frame_hash'] != frame_hash))
+    print(f"🔁 Сессия {session_id}: расстояние между кадрами {distance}")
+    if distance > SESSION_CACHE_CONFIG['max_hash_distance']:
+        return None
+    
+    entry['last_access'] = now
+    
+    # Фильтруем по текущему порогу и заново переводим метки на запрошенный язык
+    detections = []
+    for cached in entry['detections']:
+        if cached['confidence'] < confidence:
+            continue
+        detection = dict(cached)
+        detection['label'] = get_label_translation(cached['label_en'], language)
+        detections.append(detection)
+    
+    return detections
+
+def store_session_frame(session_id, frame_hash, image_shape, confidence, detections):
+    """
+    Сохраняет хэш кадра и его детекции в кэш сессии
+    
+    Args:
+        session_id (str): Идентификатор сессии клиента
+        frame_hash (np.ndarray): Перцептивный хэш кадра
+        image_shape (tuple): Размер кадра
+        confidence (float): Порог уверенности, с которым получены детекции
+        detections (list): Детекции кадра
+    """
+    now = time.monotonic()
+    
+    # Если кэш заполнен - удаляем сессию, к которой дольше всего не обращались
+    if session_id not in session_cache and len(session_cache) >= SESSION_CACHE_CONFIG['max_sessions']:
+        oldest = min(session_cache, key=lambda sid: session_cache[sid]['last_access'])
+        del session_cache[oldest]
+    
+    session_cache[session_id] = {
+        'frame_hash': frame_hash,
+        'image_shape': image_shape,
+        'confidence': confidence,
+        'detections': [dict(detection) for detection in detections],
+        'inferred_at': now,     # Время инференса - ограничивает возраст кэшированных детекций
+        'last_access': now      # Время последнего обращения - для удаления по TTL и вытеснения
+    }
+
 @app.on_event("startup")
 async def startup_event():
     """
@@ -491,7 +628,8 @@ async def startup_event():
 async def predict(
     file: UploadFile = File(...),
     confidence: float = Form(0.5),
-    language: str = Form("en")
+    language: str = Form("en"),
+    session_id: str = Form(None)
 ):
     """
     Основной endpoint для выполнения предсказания на изображении
@@ -500,12 +638,14 @@ async def predict(
         file: Загружаемое изображение (обязательный параметр)
         confidence: Порог уверенности для детекции (по умолчанию 0.5)
         language: Язык возвращаемых меток ('en' или 'ru', по умолчанию 'en')
+        session_id: Идентификатор сессии клиента (необязательный параметр).
+            Если указан, почти одинаковые кадры подряд обслуживаются из кэша сессии без инференса
     
     Returns:
         dict: Результаты детекции с переведенными метками
     """
     try:
-        print(f"🎯 Начало обработки запроса: confidence={confidence}, language={language}")
+        print(f"🎯 Начало обработки запроса: confidence={confidence}, language={language}, session_id={session_id}")
         
         # Проверяем, что модель загружена
         if current_model is None:
@@ -545,45 +685,67 @@ async def predict(
         image_array = np.array(image)
         print(f"🖼️ Размер изображения: {image_array.shape}")
         
-        # Выполняем предсказание с помощью YOLO модели
-        print(f"🔍 Выполнение предсказания YOLO с уверенностью {confidence}...")
-        # примечание: используем встроенную фильтрацию YOLO       
-        results = current_model(image_array, conf=confidence, verbose=True)
-        
-        print(f"📊 YOLO обнаружено результатов: {len(results)}")
-        
-        # Обрабатываем результаты (YOLO уже отфильтровал по confidence)
-        detections = []
-        for i, result in enumerate(results):
-            boxes = result.boxes
-            if boxes is not None:
-                print(f"📦 Результат: {len(boxes)} боксов")
-                for j, box in enumerate(boxes):
-                    box_confidence = float(box.conf)
-                    class_id = int(box.cls)
-                    original_label = current_model.names[class_id]
-                    
-                    # Получаем перевод названия класса на запрошенный язык
-                    translated_label = get_label_translation(original_label, language)
-                    
-                    print(f"  🏷️ Бокс {j}: {original_label} -> {translated_label} (ID: {class_id}), уверенность: {box_confidence:.3f}")
-                    
-                    # Формируем информацию о детекции
-                    detection = {
-                        'label': translated_label,     # Переведенная метка
-                        'label_en': original_label,    # Оригинальная английская метка
-                        'confidence': box_confidence,  # Уверенность предсказания
-                        'bbox': box.xyxy[0].tolist(),  # Координаты bounding box [x1, y1, x2, y2]
-                        'class_id': class_id           # ID класса
-                    }
-                    detections.append(detection)
-            else:
-                print(f"❌ Результат {i}: нет боксов")
-        
-        print(f"✅ Обработано детекций: {len(detections)}")
+        # Проверяем кэш сессии: для почти одинакового кадра инференс не нужен
+        from_session_cache = False
+        frame_hash = None
+        detections = None
+        results = None
+        if session_id:
+            cleanup_expired_sessions()
+            frame_hash = compute_frame_hash(image_array)
+            detections = get_cached_detections(
+                session_id, frame_hash, image_array.shape, confidence, language
+            )
+            if detections is not None:
+                from_session_cache = True
+                print(f"⚡ Кадр почти не изменился, используем кэш сессии {session_id}: {len(detections)} детекций")
         
-        # Сортируем по уверенности (от высокой к низкой)
-        detections.sort(key=lambda x: x['confidence'], reverse=True)
+        if detections is None:
+            # Выполняем предсказание с помощью YOLO модели
+            print(f"🔍 Выполнение предсказания YOLO с уверенностью {confidence}...")
+            # примечание: используем встроенную фильтрацию YOLO       
+            results = current_model(image_array, conf=confidence, verbose=True)
+            
+            print(f"📊 YOLO обнаружено результатов: {len(results)}")
+            
+            # Обрабатываем результаты (YOLO уже отфильтровал по confidence)
+            detections = []
+            for i, result in enumerate(results):
+                boxes = result.boxes
+                if boxes is not None:
+                    print(f"📦 Результат: {len(boxes)} боксов")
+                    for j, box in enumerate(boxes):
+                        box_confidence = float(box.conf)
+                        class_id = int(box.cls)
+                        original_label = current_model.names[class_id]
+                        
+                        # Получаем перевод названия класса на запрошенный язык
+                        translated_label = get_label_translation(original_label, language)
+                        
+                        print(f"  🏷️ Бокс {j}: {original_label} -> {translated_label} (ID: {class_id}), уверенность: {box_confidence:.3f}")
+                        
+                        # Формируем информацию о детекции
+                        detection = {
+                            'label': translated_label,     # Переведенная метка
+                            'label_en': original_label,    # Оригинальная английская метка
+                            'confidence': box_confidence,  # Уверенность предсказания
+                            'bbox': box.xyxy[0].tolist(),  # Координаты bounding box [x1, y1, x2, y2]
+                            'class_id': class_id           # ID класса
+                        }
+                        detections.append(detection)
+                else:
+                    print(f"❌ Результат {i}: нет боксов")
+            
+            print(f"✅ Обработано детекций: {len(detections)}")
+            
+            # Сортируем по уверенности (от высокой к низкой)
+            detections.sort(key=lambda x: x['confidence'], reverse=True)
+            
+            # Запоминаем кадр и его детекции для следующих запросов сессии
+            if session_id:
+                store_session_frame(
+                    session_id, frame_hash, image_array.shape, confidence, detections
+                )
         
         # Создаем аннотированное изображение с переведенными метками
         print("🖌️ Создаем аннотированное изображение с переведенными метками...")
@@ -611,6 +773,8 @@ async def predict(
             "language": language,
             "confidence_threshold": confidence,
             "total_detections": len(detections),
+            "session_id": session_id,
+            "from_session_cache": from_session_cache,
             "timestamp": datetime.now().isoformat()
         }
         
@@ -637,6 +801,7 @@ async def health_check():
         "translate_file": model_config.get("translate_name", "none"),
         "translations_loaded": len(translation_dict),
         "font_file": model_config.get("font_file", "none"),
+        "active_sessions": len(session_cache),
         "timestamp": datetime.now().isoformat()
     }
 